@@ -25,18 +25,34 @@ Some "standard" instruments to collect additional info about workload execution.
           be measured by these instruments. As such, they are not suitable for collected
           precise data about specific operations.
 """
+import io
 import os
 import re
+import gzip
+import mmap
+import zlib
 import logging
 import time
 import tarfile
-from itertools import izip, izip_longest
-from subprocess import CalledProcessError
+import filecmp
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import zip_longest
+from pickle import PicklingError
+from subprocess import CalledProcessError, Popen, PIPE, TimeoutExpired, check_call
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from wlauto import Instrument, Parameter
 from wlauto.core import signal
 from wlauto.exceptions import DeviceError, ConfigError
-from wlauto.utils.misc import diff_tokens, write_table, check_output, as_relative
+from wlauto.utils.misc import diff_tokens, write_table, check_output, as_relative, which
+from wlauto.utils.misc import escape_single_quotes
 from wlauto.utils.misc import ensure_file_directory_exists as _f
 from wlauto.utils.misc import ensure_directory_exists as _d
 from wlauto.utils.android import ApkInfo
@@ -45,6 +61,28 @@ from wlauto.utils.types import list_of_strings
 
 logger = logging.getLogger(__name__)
 
+_NONWORD_SPLIT = re.compile(r'(\W+)')
+
+# Diffing a file against an identical copy zeroes every all-digit token, except the
+# leading one on a line with exactly two non-blank tokens, which is treated as a
+# "header" (see _diff_sysfs_file). This reproduces that in a single pass.
+_UNCHANGED_COUNTER = re.compile(r'(?P<header>^\d+(?=[^\w\n]*[^\w\s][^\w\n]*$|[^\S\n]+\w+[^\S\n]*$))'
+                                r'|(?<!\w)\d+(?!\w)', re.MULTILINE)
+
+_BUFSZ = 1 << 20
+
+# Measured on an x86 host: diffing a sysfs node serially costs ~50us, while each
+# pool worker costs ~2ms to fork plus ~6us per file in IPC, so a pool only pays
+# off above roughly 250 (4 cores) to 450 (8 cores) files.
+_PARALLEL_DIFF_THRESHOLD = 500
+
+# Workers must inherit the instrument module, which WA loads from a file path
+# under a synthetic name that spawned/forkserver workers cannot re-import.
+if 'fork' in multiprocessing.get_all_start_methods():
+    _FORK_CONTEXT = multiprocessing.get_context('fork')
+else:
+    _FORK_CONTEXT = None
+
 
 class SysfsExtractor(Instrument):
 
@@ -97,103 +135,63 @@ class SysfsExtractor(Instrument):
                                     as_root=True)
 
     def setup(self, context):
-        before_dirs = [
-            _d(os.path.join(context.output_directory, 'before', self._local_dir(d)))
+        self.device_and_host_paths = [
+            (d,
+             _d(os.path.join(context.output_directory, 'before', self._local_dir(d))),
+             _d(os.path.join(context.output_directory, 'after', self._local_dir(d))),
+             _d(os.path.join(context.output_directory, 'diff', self._local_dir(d))))
             for d in self.paths
         ]
-        after_dirs = [
-            _d(os.path.join(context.output_directory, 'after', self._local_dir(d)))
-            for d in self.paths
-        ]
-        diff_dirs = [
-            _d(os.path.join(context.output_directory, 'diff', self._local_dir(d)))
-            for d in self.paths
-        ]
-        self.device_and_host_paths = zip(self.paths, before_dirs, after_dirs, diff_dirs)
 
         if self.use_tmpfs:
+            # Reset all snapshot directories with a single shell invocation rather
+            # than several device round-trips per path.
+            join = self.device.path.join
+            dirname = self.device.path.dirname
+            commands = []
             for d in self.paths:
-                before_dir = self.device.path.join(self.on_device_before,
-                                                   self.device.path.dirname(as_relative(d)))
-                after_dir = self.device.path.join(self.on_device_after,
-                                                  self.device.path.dirname(as_relative(d)))
-                if self.device.file_exists(before_dir):
-                    self.device.execute('rm -rf  {}'.format(before_dir), as_root=True)
-                self.device.execute('mkdir -p {}'.format(before_dir), as_root=True)
-                if self.device.file_exists(after_dir):
-                    self.device.execute('rm -rf  {}'.format(after_dir), as_root=True)
-                self.device.execute('mkdir -p {}'.format(after_dir), as_root=True)
+                parent_dir = dirname(as_relative(d))
+                before_dir = join(self.on_device_before, parent_dir)
+                after_dir = join(self.on_device_after, parent_dir)
+                commands.append('rm -rf {0} && mkdir -p {0}'.format(before_dir))
+                commands.append('rm -rf {0} && mkdir -p {0}'.format(after_dir))
+            self.device.execute(' && '.join(commands), as_root=True)
 
     def slow_start(self, context):
         if self.use_tmpfs:
-            for d in self.paths:
-                dest_dir = self.device.path.join(self.on_device_before, as_relative(d))
-                if '*' in dest_dir:
-                    dest_dir = self.device.path.dirname(dest_dir)
-                self.device.execute('{} cp -Hr {} {}'.format(self.device.busybox, d, dest_dir),
-                                    as_root=True, check_exit_code=False)
+            self._copy_to_tmpfs(self.on_device_before)
         else:  # not rooted
-            for dev_dir, before_dir, _, _ in self.device_and_host_paths:
-                self.device.pull_file(dev_dir, before_dir)
+            self._bulk_pull(self.paths, os.path.join(context.output_directory, 'before'))
 
     def slow_stop(self, context):
         if self.use_tmpfs:
-            for d in self.paths:
-                dest_dir = self.device.path.join(self.on_device_after, as_relative(d))
-                if '*' in dest_dir:
-                    dest_dir = self.device.path.dirname(dest_dir)
-                self.device.execute('{} cp -Hr {} {}'.format(self.device.busybox, d, dest_dir),
-                                    as_root=True, check_exit_code=False)
+            self._copy_to_tmpfs(self.on_device_after)
         else:  # not using tmpfs
-            for dev_dir, _, after_dir, _ in self.device_and_host_paths:
-                self.device.pull_file(dev_dir, after_dir)
+            self._bulk_pull(self.paths, os.path.join(context.output_directory, 'after'))
 
     def update_result(self, context):
         if self.use_tmpfs:
-            on_device_tarball = self.device.path.join(self.device.working_directory, self.tarname)
-            on_host_tarball = self.device.path.join(context.output_directory, self.tarname + ".gz")
-            self.device.execute('{} tar cf {} -C {} .'.format(self.device.busybox,
-                                                              on_device_tarball,
-                                                              self.tmpfs_mount_point),
-                                as_root=True)
-            self.device.execute('chmod 0777 {}'.format(on_device_tarball), as_root=True)
-            self.device.execute('{} gzip -f {}'.format(self.device.busybox,
-                                                       on_device_tarball))
-            self.device.pull_file(on_device_tarball + ".gz", on_host_tarball)
-            with tarfile.open(on_host_tarball, 'r:gz') as tf:
-                def is_within_directory(directory, target):
-                    
-                    abs_directory = os.path.abspath(directory)
-                    abs_target = os.path.abspath(target)
-                
-                    prefix = os.path.commonprefix([abs_directory, abs_target])
-                    
-                    return prefix == abs_directory
-                
-                def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                
-                    for member in tar.getmembers():
-                        member_path = os.path.join(path, member.name)
-                        if not is_within_directory(path, member_path):
-                            raise Exception("Attempted Path Traversal in Tar File")
-                
-                    tar.extractall(path, members, numeric_owner=numeric_owner) 
-                    
-                
-                safe_extract(tf, context.output_directory)
-            self.device.delete_file(on_device_tarball + ".gz")
-            os.remove(on_host_tarball)
+            if not self._stream_tmpfs_snapshot(context.output_directory):
+                self._pull_tmpfs_snapshot(context.output_directory)
 
+        pulled_paths = []
         for paths in self.device_and_host_paths:
             after_dir = paths[self.AFTER_PATH]
             dev_dir = paths[self.DEVICE_PATH].strip('*')  # remove potential trailing '*'
-            if (not os.listdir(after_dir) and
-                    self.device.file_exists(dev_dir) and
-                    self.device.listdir(dev_dir)):
-                self.logger.error('sysfs files were not pulled from the device.')
-                self.device_and_host_paths.remove(paths)  # Path is removed to skip diffing it
+            if not os.listdir(after_dir):
+                try:
+                    device_entries = self.device.listdir(dev_dir)
+                except (DeviceError, CalledProcessError):
+                    device_entries = []  # path does not exist on the device
+                if device_entries:
+                    self.logger.error('sysfs files were not pulled from the device.')
+                    continue  # Path is dropped to skip diffing it
+            pulled_paths.append(paths)
+        self.device_and_host_paths = pulled_paths
+        diff_jobs = []
         for _, before_dir, after_dir, diff_dir in self.device_and_host_paths:
-            _diff_sysfs_dirs(before_dir, after_dir, diff_dir)
+            diff_jobs.extend(_sysfs_diff_jobs(before_dir, after_dir, diff_dir))
+        _diff_sysfs_files(diff_jobs)
 
     def teardown(self, context):
         self._one_time_setup_done = []
@@ -213,7 +211,123 @@ class SysfsExtractor(Instrument):
             self.tmpfs_mount_point = self.device.path.join(self.device.working_directory, 'temp-fs')
 
     def _local_dir(self, directory):
-        return os.path.dirname(as_relative(directory).replace(self.device.path.sep, os.sep))
+        return _to_local_dir(directory, self.device.path.sep)
+
+    def _copy_to_tmpfs(self, snapshot_dir):
+        join = self.device.path.join
+        dirname = self.device.path.dirname
+        execute = self.device.execute
+        busybox = self.device.busybox
+        for d in self.paths:
+            dest_dir = join(snapshot_dir, as_relative(d))
+            if '*' in dest_dir:
+                dest_dir = dirname(dest_dir)
+            execute('{} cp -Hr {} {}'.format(busybox, d, dest_dir),
+                    as_root=True, check_exit_code=False)
+
+    def _stream_tmpfs_snapshot(self, dest):
+        # Pipe the archive straight off the device into the host's tar, so that
+        # compression, transfer and extraction overlap and nothing is staged on
+        # the device. Returns False if this is not possible on this device/host.
+        if self.device.platform != 'android' or not which('tar'):
+            return False
+        command = '{0} tar cf - -C {1} . | {0} gzip -c'.format(self.device.busybox, self.tmpfs_mount_point)
+        command = "echo '{}' | su".format(escape_single_quotes(command))
+        adb = Popen(_adb_command(self.device, 'exec-out', command), stdout=PIPE)
+        tar = Popen(['tar', '-xzf', '-', '-C', dest], stdin=adb.stdout)
+        adb.stdout.close()  # allow adb to receive SIGPIPE if tar exits early
+        try:
+            tar_returncode = tar.wait(timeout=self.extract_timeout)
+            adb_returncode = adb.wait(timeout=self.extract_timeout)
+        except TimeoutExpired:
+            for process in (adb, tar):
+                process.kill()
+                process.wait()
+            self.logger.debug('Timed out streaming {} from the device.'.format(self.tmpfs_mount_point))
+            return False
+        # The device-side exit status is not reliably passed back by adb, and gzip
+        # emits a valid empty stream if su or tar fail, so also check that this
+        # instrument's snapshots were actually extracted.
+        if tar_returncode or adb_returncode or not self._snapshots_extracted():
+            self.logger.debug('Could not stream {} from the device; falling back to pulling '
+                              'a tarball.'.format(self.tmpfs_mount_point))
+            return False
+        return True
+
+    def _snapshots_extracted(self):
+        # Other instruments (e.g. interrupts) write into the same before/after
+        # trees, so look for each of our own paths rather than for any file.
+        # Glob paths (copied as the directory's contents) may legitimately match
+        # nothing, so they are only relied upon if there is nothing else to check.
+        targets = []
+        glob_targets = []
+        for d, before_dir, after_dir, _ in self.device_and_host_paths:
+            if '*' in d:
+                glob_targets.extend([before_dir, after_dir])
+            else:
+                name = self.device.path.basename(d)
+                targets.extend([os.path.join(before_dir, name), os.path.join(after_dir, name)])
+        if targets:
+            return all(_snapshot_exists(t) for t in targets)
+        return any(_snapshot_exists(t) for t in glob_targets)
+
+    def _pull_tmpfs_snapshot(self, dest):
+        on_device_tarball = self.device.path.join(self.device.working_directory, self.tarname + ".gz")
+        on_host_tarball = os.path.join(dest, self.tarname + ".gz")
+        # Compress as the archive is being written, rather than writing out the
+        # uncompressed tarball and reading it back in for a separate gzip pass.
+        self.device.execute('{0} tar cf - -C {1} . | {0} gzip -c > {2}'.format(self.device.busybox,
+                                                                               self.tmpfs_mount_point,
+                                                                               on_device_tarball),
+                            as_root=True)
+        self.device.execute('chmod 0777 {}'.format(on_device_tarball), as_root=True)
+        self.device.pull_file(on_device_tarball, on_host_tarball)
+        _extract_tarball(on_host_tarball, dest)
+        self.device.delete_file(on_device_tarball)
+        os.remove(on_host_tarball)
+
+    def _bulk_pull(self, paths, dest_root):
+        # Pull all paths in a single transfer: snapshot them on the device, tar up
+        # the snapshot, pull the tarball and unpack it locally. sysfs files report
+        # a size of 4096 regardless of their contents, which tar cannot archive
+        # directly, so they are copied first (cp reads to EOF), as with tmpfs.
+        join = self.device.path.join
+        dirname = self.device.path.dirname
+        busybox = self.device.busybox
+        staging_dir = join(self.device.working_directory, self.tarname + '.d')
+        on_device_tarball = join(self.device.working_directory, self.tarname)
+        on_host_tarball = os.path.join(dest_root, self.tarname)
+
+        commands = ['rm -rf {0} && mkdir -p {0}'.format(staging_dir)]
+        for d in paths:
+            dest_dir = join(staging_dir, as_relative(d))
+            if '*' in dest_dir:
+                dest_dir = dirname(dest_dir)
+            # cp exits non-zero on unreadable nodes; that is expected, so carry on.
+            commands.append('mkdir -p {} ; {} cp -Hr {} {}'.format(dirname(dest_dir), busybox, d, dest_dir))
+        commands.append('{} tar cf {} -C {} .'.format(busybox, on_device_tarball, staging_dir))
+        try:
+            self.device.execute(' ; '.join(commands))
+            self.device.pull_file(on_device_tarball, on_host_tarball)
+            _extract_tarball(on_host_tarball, dest_root)
+        except (DeviceError, CalledProcessError, tarfile.TarError):
+            self.logger.debug('Could not transfer {} as a tarball; pulling paths '
+                              'individually.'.format(on_device_tarball))
+            self._concurrent_pull(paths, dest_root)
+        finally:
+            self.device.execute('rm -rf {} {}'.format(staging_dir, on_device_tarball),
+                                check_exit_code=False)
+            if os.path.isfile(on_host_tarball):
+                os.remove(on_host_tarball)
+
+    def _concurrent_pull(self, paths, dest_root):
+        # Individual pulls are dominated by adb round-trip latency, so keep several
+        # of them in flight at once.
+        pulls = [(d, os.path.join(dest_root, self._local_dir(d))) for d in paths]
+        if not pulls:
+            return
+        with ThreadPoolExecutor(max_workers=min(8, len(pulls))) as executor:
+            list(executor.map(lambda args: self.device.pull_file(*args), pulls))
 
 
 class ExecutionTimeInstrument(Instrument):
@@ -236,10 +350,10 @@ class ExecutionTimeInstrument(Instrument):
         signal.connect(self.get_stop_time, signal.AFTER_WORKLOAD_EXECUTION, priority=self.priority)
 
     def get_start_time(self, context):
-        self.start_time = time.time()
+        self.start_time = time.monotonic()
 
     def get_stop_time(self, context):
-        self.end_time = time.time()
+        self.end_time = time.monotonic()
 
     def update_result(self, context):
         execution_time = self.end_time - self.start_time
@@ -255,6 +369,8 @@ class InterruptStatsInstrument(Instrument):
 
     """
 
+    dump_timeout = 30
+
     def __init__(self, device, **kwargs):
         super(InterruptStatsInstrument, self).__init__(device, **kwargs)
         self.before_file = None
@@ -267,18 +383,37 @@ class InterruptStatsInstrument(Instrument):
         self.diff_file = os.path.join(context.output_directory, 'diff', 'proc', 'interrupts')
 
     def start(self, context):
-        with open(_f(self.before_file), 'w') as wfh:
-            wfh.write(self.device.execute('cat /proc/interrupts'))
+        self._dump_to_file('/proc/interrupts', self.before_file)
 
     def stop(self, context):
-        with open(_f(self.after_file), 'w') as wfh:
-            wfh.write(self.device.execute('cat /proc/interrupts'))
+        self._dump_to_file('/proc/interrupts', self.after_file)
 
     def update_result(self, context):
         # If workload execution failed, the after_file may not have been created.
         if os.path.isfile(self.after_file):
             _diff_interrupt_files(self.before_file, self.after_file, _f(self.diff_file))
 
+    def _dump_to_file(self, device_path, host_path):
+        if self.device.platform == 'android':
+            # Stream adb's output straight into the file rather than buffering it.
+            # exec-out avoids the pty that 'adb shell' uses on older adb (which
+            # mangles newlines and hides cat's exit status); if it fails or yields
+            # nothing, fall back to device.execute(), which reports errors properly.
+            with open(_f(host_path), 'wb') as wfh:
+                try:
+                    check_call(_adb_command(self.device, 'exec-out', 'cat', device_path),
+                               stdout=wfh, timeout=self.dump_timeout)
+                    streamed = True
+                except TimeoutExpired:  # check_call() has already killed adb
+                    raise DeviceError('Timed out reading {} from the device.'.format(device_path))
+                except CalledProcessError:
+                    streamed = False
+            if streamed and os.path.getsize(host_path):
+                return
+            self.logger.debug('Could not stream {} over adb exec-out.'.format(device_path))
+        with open(_f(host_path), 'w') as wfh:
+            wfh.write(self.device.execute('cat {}'.format(device_path)))
+
 
 class DynamicFrequencyInstrument(SysfsExtractor):
 
@@ -306,28 +441,86 @@ class DynamicFrequencyInstrument(SysfsExtractor):
             self.tmpfs_mount_point += '-cpufreq'
 
 
+def _adb_command(device, *args):
+    # adb_name is only set when more than one device may be attached.
+    command = ['adb']
+    if device.adb_name:
+        command.extend(['-s', device.adb_name])
+    command.extend(args)
+    return command
+
+
+def _safe_extract(tar, path=".", members=None, numeric_owner=False):
+    if getattr(tarfile, 'data_filter', None):
+        # The stdlib filter rejects unsafe members as they are extracted, so there
+        # is no need for a separate validation pass.
+        tar.extractall(path, members, numeric_owner=numeric_owner, filter='data')
+        return
+    root = os.path.abspath(path)
+    root_sep = root.rstrip(os.sep) + os.sep
+    if members is None:
+        members = tar.getmembers()
+    for member in members:
+        abs_target = os.path.abspath(os.path.join(root, member.name))
+        if not (abs_target == root or abs_target.startswith(root_sep)):
+            raise Exception("Attempted Path Traversal in Tar File")
+    tar.extractall(path, members, numeric_owner=numeric_owner)
+
+
+@lru_cache(maxsize=256)
+def _to_local_dir(directory, device_sep):
+    return os.path.dirname(as_relative(directory).replace(device_sep, os.sep))
+
+
+def _extract_tarball(tarball, path):
+    # Native tar is much faster than tarfile for archives with thousands of small
+    # members; fall back to tarfile on hosts without it (e.g. Windows).
+    if which('tar'):
+        check_output(['tar', '-xf', tarball, '-C', path])
+    else:
+        # Map the tarball and inflate it in one go rather than through tarfile's
+        # small buffered reads.
+        with open(tarball, 'rb') as fh:
+            try:
+                data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # cannot map an empty file
+                raise tarfile.ReadError('{} is empty'.format(tarball))
+            try:
+                if data[:2] == b'\x1f\x8b':  # gzip magic
+                    try:
+                        fileobj = io.BytesIO(gzip.decompress(data))
+                    except (EOFError, OSError, zlib.error) as e:  # truncated or corrupt
+                        raise tarfile.ReadError('{}: {}'.format(tarball, e))
+                else:
+                    fileobj = data
+                with tarfile.open(fileobj=fileobj) as tf:
+                    _safe_extract(tf, path)
+            finally:
+                data.close()
+
+
 def _diff_interrupt_files(before, after, result):  # pylint: disable=R0914
-    output_lines = []
+    # /proc/interrupts is small, so read both snapshots in full and match rows up
+    # by their label (the first column) rather than walking the files in step.
     with open(before) as bfh:
-        with open(after) as ofh:
-            for bline, aline in izip(bfh, ofh):
-                bchunks = bline.strip().split()
-                while True:
-                    achunks = aline.strip().split()
-                    if achunks[0] == bchunks[0]:
-                        diffchunks = ['']
-                        diffchunks.append(achunks[0])
-                        diffchunks.extend([diff_tokens(b, a) for b, a
-                                           in zip(bchunks[1:], achunks[1:])])
-                        output_lines.append(diffchunks)
-                        break
-                    else:  # new category appeared in the after file
-                        diffchunks = ['>'] + achunks
-                        output_lines.append(diffchunks)
-                        try:
-                            aline = ofh.next()
-                        except StopIteration:
-                            break
+        before_rows = {chunks[0]: chunks[1:] for chunks in (line.split() for line in bfh.read().splitlines())
+                       if chunks}
+    with open(after) as afh:
+        after_rows = [chunks for chunks in (line.split() for line in afh.read().splitlines()) if chunks]
+
+    output_lines = []
+    matched = []
+    for achunks in after_rows:
+        bcols = before_rows.get(achunks[0])
+        if bcols is None:  # new category appeared in the after file
+            output_lines.append(['>'] + achunks)
+        else:
+            diffchunks = ['', achunks[0]]
+            output_lines.append(diffchunks)
+            matched.append((diffchunks, bcols, achunks[1:]))
+
+    # The heading row is "CPU0 CPU1 ...", so it has one column per CPU.
+    _diff_interrupt_counts(matched, len(after_rows[0]))
 
     # Offset heading columns by one to allow for row labels on subsequent
     # lines.
@@ -348,39 +541,112 @@ def _diff_interrupt_files(before, after, result):  # pylint: disable=R0914
         write_table(table_rows, wfh)
 
 
-def _diff_sysfs_dirs(before, after, result):  # pylint: disable=R0914
-    before_files = []
-    os.path.walk(before,
-                 lambda arg, dirname, names: arg.extend([os.path.join(dirname, f) for f in names]),
-                 before_files
-                 )
-    before_files = filter(os.path.isfile, before_files)
+def _diff_interrupt_counts(rows, num_cpus):
+    # rows are (diffchunks, before_columns, after_columns); the diffed columns are
+    # appended to diffchunks. Per-CPU counts are diffed as a single integer matrix
+    # subtraction when numpy is available, rather than token by token.
+    numeric = []
+    for row in rows:
+        diffchunks, bcols, acols = row
+        if (np is not None and len(bcols) >= num_cpus and len(acols) >= num_cpus and
+                all(c.isdigit() for c in bcols[:num_cpus] + acols[:num_cpus])):
+            numeric.append(row)
+        else:
+            diffchunks.extend(diff_tokens(b, a) for b, a in zip(bcols, acols))
+
+    if numeric:
+        before_mat = np.array([bcols[:num_cpus] for _, bcols, _ in numeric], dtype=np.int64)
+        after_mat = np.array([acols[:num_cpus] for _, _, acols in numeric], dtype=np.int64)
+        diff_mat = (after_mat - before_mat).astype(str).tolist()
+        for (diffchunks, bcols, acols), counts in zip(numeric, diff_mat):
+            diffchunks.extend(counts)
+            diffchunks.extend(diff_tokens(b, a) for b, a in zip(bcols[num_cpus:], acols[num_cpus:]))
+
+
+def _sysfs_diff_jobs(before, after, result):
+    before_files = _list_files(before)
     files = [os.path.relpath(f, before) for f in before_files]
     after_files = [os.path.join(after, f) for f in files]
     diff_files = [os.path.join(result, f) for f in files]
 
+    triples = []
     for bfile, afile, dfile in zip(before_files, after_files, diff_files):
         if not os.path.isfile(afile):
             logger.debug('sysfs_diff: {} does not exist or is not a file'.format(afile))
             continue
-
-        with open(bfile) as bfh, open(afile) as afh:  # pylint: disable=C0321
-            with open(_f(dfile), 'w') as dfh:
-                for i, (bline, aline) in enumerate(izip_longest(bfh, afh), 1):
-                    if aline is None:
-                        logger.debug('Lines missing from {}'.format(afile))
-                        break
-                    bchunks = re.split(r'(\W+)', bline)
-                    achunks = re.split(r'(\W+)', aline)
-                    if len(bchunks) != len(achunks):
-                        logger.debug('Token length mismatch in {} on line {}'.format(bfile, i))
-                        dfh.write('xxx ' + bline)
-                        continue
-                    if ((len([c for c in bchunks if c.strip()]) == len([c for c in achunks if c.strip()]) == 2) and
-                            (bchunks[0] == achunks[0])):
-                        # if there are only two columns and the first column is the
-                        # same, assume it's a "header" column and do not diff it.
-                        dchunks = [bchunks[0]] + [diff_tokens(b, a) for b, a in zip(bchunks[1:], achunks[1:])]
-                    else:
-                        dchunks = [diff_tokens(b, a) for b, a in zip(bchunks, achunks)]
-                    dfh.write(''.join(dchunks))
+        _f(dfile)  # create directories up front so that workers do not race on them
+        triples.append((bfile, afile, dfile))
+    return triples
+
+
+def _diff_sysfs_files(triples):
+    # Each file is diffed independently, so spread them across host cores --
+    # but only when there are enough of them to pay for starting the pool.
+    workers = os.cpu_count() or 1
+    if workers > 1 and _FORK_CONTEXT and len(triples) >= _PARALLEL_DIFF_THRESHOLD:
+        try:
+            with ProcessPoolExecutor(workers, mp_context=_FORK_CONTEXT) as executor:
+                list(executor.map(_diff_sysfs_file, triples, chunksize=32))
+            return
+        except (BrokenProcessPool, PicklingError):
+            logger.debug('sysfs_diff: worker pool failed; diffing serially.')
+    for triple in triples:
+        _diff_sysfs_file(triple)
+
+
+def _list_files(root):
+    # Use the file type reported by readdir() rather than stat()'ing every entry.
+    files = []
+    pending = [root]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue  # missing or unreadable directory; skip it, as os.walk() does
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(entry.path)
+    return files
+
+
+def _snapshot_exists(path):
+    return os.path.isfile(path) or (os.path.isdir(path) and bool(os.listdir(path)))
+
+
+def _diff_sysfs_file(triple):
+    bfile, afile, dfile = triple
+    if filecmp.cmp(bfile, afile, shallow=False):
+        # Nothing changed; skip tokenising the file line by line.
+        with open(bfile) as bfh, open(dfile, 'w') as dfh:  # pylint: disable=C0321
+            dfh.write(_UNCHANGED_COUNTER.sub(_zero_counter, bfh.read()))
+        return
+    with open(bfile, buffering=_BUFSZ) as bfh, open(afile, buffering=_BUFSZ) as afh:  # pylint: disable=C0321
+        with open(dfile, 'w') as dfh:
+            for i, (bline, aline) in enumerate(zip_longest(bfh, afh), 1):
+                if aline is None:
+                    logger.debug('Lines missing from {}'.format(afile))
+                    break
+                bchunks = _NONWORD_SPLIT.split(bline)
+                achunks = _NONWORD_SPLIT.split(aline)
+                if len(bchunks) != len(achunks):
+                    logger.debug('Token length mismatch in {} on line {}'.format(bfile, i))
+                    dfh.write('xxx ' + bline)
+                    continue
+                if bchunks[0] == achunks[0] and _count_tokens(bchunks) == _count_tokens(achunks) == 2:
+                    # if there are only two columns and the first column is the
+                    # same, assume it's a "header" column and do not diff it.
+                    dchunks = [bchunks[0]] + [diff_tokens(b, a) for b, a in zip(bchunks[1:], achunks[1:])]
+                else:
+                    dchunks = [diff_tokens(b, a) for b, a in zip(bchunks, achunks)]
+                dfh.write(''.join(dchunks))
+
+
+def _count_tokens(chunks):
+    return sum(1 for c in chunks if c.strip())
+
+
+def _zero_counter(match):
+    return match.group('header') or '0'